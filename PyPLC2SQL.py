@@ -8,6 +8,7 @@ and store the data in a relational database.
 
 from collections import OrderedDict, namedtuple
 import time
+import calendar
 from datetime import datetime as dt
 import signal
 import sys
@@ -32,6 +33,12 @@ OPC_TS = 3
 OPC_STA_NAME = 4
 OPC_PRD_LINE = 5
 OPC_STATION = 6
+OPC_GOOD = 'Good'
+# OpenOPC formats timestamps as MM/DD/YY, so it is tried first
+OPENOPC_TS_FORMAT = '%m/%d/%y %H:%M:%S'
+OPC_TS_FORMATS = (OPENOPC_TS_FORMAT,
+                  '%Y-%m-%d %H:%M:%S.%f',
+                  '%Y-%m-%d %H:%M:%S')
 CSV_TAG = 0
 CSV_NAME = 1
 TRIGGERS = {'VALUE_CHANGE': 1,
@@ -47,6 +54,10 @@ TRIGGERS = {'VALUE_CHANGE': 1,
 PASSWORD = 'Password'
 SUCCESS = "--------->Success\n"
 LINE = '=' * 140
+DB_TS_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# value, quality and source timestamp of a single OPC item
+OPCItem = namedtuple('OPCItem', ['value', 'quality', 'time_stamp'])
 # </editor-fold>
 
 
@@ -109,7 +120,8 @@ PLC_Hist_Data
                     (ex. 1, 4, 45938, any positive integer)
         val - the value being stored. This may be any data less than 50 characters
                     (ex. 1, 0, 34.232143, 'motor running')
-        time_stamp - the time of the datachange event.
+        time_stamp - the OPC source time of the datachange event.
+                    (whole seconds; rows with the same time_stamp are in order of their id)
 
 PLC_Live_Data
 
@@ -122,7 +134,9 @@ PLC_Live_Data
                     (ex. 1, 4, 45938, any positive integer)
         val - the value being stored. This may be any data less than 50 characters
                     (ex. 1, 0, 34.232143, 'motor running')
-        time_stamp - the time of the most recent data change event.
+        time_stamp - the OPC source time of the most recent data change or quality change event.
+        quality - the OPC quality of the tag. Changes away from 'Good' are recorded once, when they
+                    happen, and the last good value is kept. (ex. Good, Bad, Uncertain)
 
 --------------------------------------------------------------------------------------------------------------------
 
@@ -188,10 +202,14 @@ OPC SERVER:
 
         OPC_HOST>localhost
         OPC_PORT>None
+        OPC_TS_UTC>True
 
     Notes:
 
         OPC_PORT is ignored if 'localhost' is used.
+        OPC_TS_UTC tells whether the OPC server's item timestamps are UTC (the OPC default). They are converted
+    to local time, so the OPC server and this machine should agree on the time. Set it to False if the server
+    already reports local time.
         See http://openopc.sourceforge.net/ for more details.
 
 --------------------------------------------------------------------------------------------------------------------
@@ -220,12 +238,20 @@ parser.add_option('-e', '--export_db', action='store_true', default=False, dest=
 app = None
 # </editor-fold>
 
+# timestamp format of the OPC server, found from the first timestamp parsed
+opc_ts_format = None
+opc_ts_warned = False
+
 
 def is_outside_deadband(prev, current, deadband):
     """
     takes a previous value, current value and a deadband percentage and computes
     whether the current value is outside a deadband of the previous value
     """
+    # no previous value (ex. the tag was bad quality when first read), so treat it as a change
+    if prev is None:
+        return True
+
     # handle case where user puts in a whole percentage (ex 70%) or a decimal number (ex .70)
     if deadband > 1:
         deadband /= 100.0
@@ -239,6 +265,63 @@ def is_outside_deadband(prev, current, deadband):
     return lower < current < upper
 
 
+def utc_to_local(ts):
+    """
+    converts a UTC datetime to local time, using the UTC offset in effect at that time (not now),
+    so batched or replayed reads across a daylight saving change land at the right local time
+    """
+    return dt.fromtimestamp(calendar.timegm(ts.timetuple())).replace(microsecond=ts.microsecond)
+
+
+def parse_opc_timestamp(ts, utc=False):
+    """
+    converts the timestamp string of an OPC item into a local datetime, converting it from UTC if utc is set.
+
+    The server's format is found once and reused, so parsing only fails over to the other
+    OPC_TS_FORMATS if the server changes format.  Items without a usable source timestamp fall
+    back to the local time of the read; the first time that happens a warning is printed.
+    """
+    global opc_ts_format, opc_ts_warned
+    stamp = None
+    if isinstance(ts, dt):
+        stamp = ts
+    elif ts:
+        ts = str(ts)
+        # strptime is slow for every tag on every scan, so the fixed width OpenOPC format is sliced directly
+        if len(ts) == 17 and ts[2] == ts[5] == '/' and ts[8] == ' ' and ts[11] == ts[14] == ':':
+            try:
+                stamp = dt(2000 + int(ts[6:8]), int(ts[0:2]), int(ts[3:5]),
+                           int(ts[9:11]), int(ts[12:14]), int(ts[15:17]))
+            except ValueError:
+                pass
+        if stamp is None and opc_ts_format:
+            try:
+                stamp = dt.strptime(ts, opc_ts_format)
+            except ValueError:
+                pass
+        if stamp is None:
+            for ts_format in OPC_TS_FORMATS:
+                try:
+                    stamp = dt.strptime(ts, ts_format)
+                except ValueError:
+                    continue
+                opc_ts_format = ts_format
+                break
+    if stamp is not None:
+        return utc_to_local(stamp) if utc else stamp
+    if ts and not opc_ts_warned:
+        print 'Unrecognized OPC timestamp %r. Using local read time instead.' % ts
+        opc_ts_warned = True
+    return dt.now()
+
+
+def format_timestamp(ts):
+    """
+    formats a datetime the way it is written to the database (millisecond resolution)
+    """
+    return ts.strftime(DB_TS_FORMAT)[:-3:]
+
+
 def restart():
     """
     Attempts to restart the application.
@@ -377,7 +460,8 @@ class PyPLC2SQL(object):
         self.db.define_table('PLC_Live_Data',
                              Field('tag_id', self.db.PLC_Tags, readable=True),
                              Field('time_stamp', 'datetime', readable=True),
-                             Field('val', 'string', length=50, readable=True), migrate=True)
+                             Field('val', 'string', length=50, readable=True),
+                             Field('quality', 'string', length=50, readable=True), migrate=True)
 
         self.db.define_table('PLC_Events',
                              Field('tag_id', self.db.PLC_Tags, readable=True),
@@ -492,13 +576,30 @@ class PyPLC2SQL(object):
     def read_tags(self):
         try:
             # Get the tags from the file, load them into an OPC group
-            output_data = OrderedDict((k, (v[OPC_VALUE], v[OPC_QUALITY])) for k, v in
-                                      zip(self._tags, self._opc.read(self._tags, group="PyPLC2SQL")))
+            output_data = self._opc_items_to_state(self._opc.read(self._tags, group="PyPLC2SQL"))
             return output_data
         except OpenOPC.OPCError, e:
             print 'OpenOPC Error:', e
             restart()
 
+    def _opc_items_to_state(self, opc_items):
+        """
+        converts the item tuples of an OPC read into an OrderedDict of tag: OPCItem.
+
+        OPC source timestamps are UTC unless OPC_TS_UTC is False in the CONFIG_FILE and are converted
+        to local time to match the rest of the database.  Items share few distinct timestamps, so each
+        distinct timestamp is parsed and converted only once per read.
+        """
+        utc = getattr(self._CONFIG, 'OPC_TS_UTC', 'True').strip().upper() != 'FALSE'
+        stamps = {}
+        output_data = OrderedDict()
+        for k, v in zip(self._tags, opc_items):
+            ts = v[OPC_TS]
+            if ts not in stamps:
+                stamps[ts] = parse_opc_timestamp(ts, utc)
+            output_data[k] = OPCItem(v[OPC_VALUE], v[OPC_QUALITY], stamps[ts])
+        return output_data
+
     def trigger_detect(self, tag_id):
         """
         detects trigger conditions for tag states read from the PLC and returns whether the tag should be logged
@@ -518,8 +619,8 @@ class PyPLC2SQL(object):
         tag_row = self.plc_tags_dict[tag_id]
         trigger = tag_row.insert_trigger
         setting = map(float, tag_row.trigger_setting)
-        cur_val, quality = self._current_state[tag_row.tag_name]
-        prev_val = self._prev_state[tag_row.tag_name][0]
+        cur_val = self._current_state[tag_row.tag_name].value
+        prev_val = self._prev_state[tag_row.tag_name].value
         if ((self._options.init
              or trigger == TRIGGERS['VALUE_CHANGE'] and not (cur_val != prev_val)
              or trigger == TRIGGERS['DEADBAND'] and not (is_outside_deadband(prev_val, cur_val, setting[0]))
@@ -554,6 +655,152 @@ class PyPLC2SQL(object):
         else:
             return False
 
+    def _load_tag_rows(self):
+        """
+        copy tags table from db into memory so we can use it if the db locks up
+        """
+        plc_tags_rows = self.db().select(self.db.PLC_Tags.ALL)
+        for row in plc_tags_rows:
+            row.trigger_setting = row.trigger_setting.split('/')
+            row.time = time.time()
+            row.flag = False
+            # last recorded OPC quality and source timestamp for the tag, picked up from the live data
+            # so a restart does not let an older replayed read roll the live data back
+            row.quality = OPC_GOOD
+            row.time_stamp = None
+            row.live = False
+            self.plc_tags_dict[row['id']] = row
+
+        for live_row in self.db().select(self.db.PLC_Live_Data.ALL):
+            if live_row.tag_id in self.plc_tags_dict:
+                tag_row = self.plc_tags_dict[live_row.tag_id]
+                tag_row.quality = live_row.quality or OPC_GOOD
+                tag_row.time_stamp = live_row.time_stamp
+                tag_row.live = True
+
+    @staticmethod
+    def _is_current(tag_row, item):
+        """
+        batched or replayed reads can be older than what is already live; those never roll the live data back
+        """
+        return tag_row.time_stamp is None or item.time_stamp >= tag_row.time_stamp
+
+    def _record_quality_changes(self, quality_changes):
+        """
+        records the changes of OPC quality collected by scan(), as {(quality, time_stamp): [tag rows]}.
+
+        Tags that drop out together share a quality and source timestamp, so a whole PLC going offline
+        is one update of PLC_Live_Data (plus one insert for tags without a live row yet) and one commit.
+        """
+        for (quality, time_stamp), tag_rows in quality_changes.iteritems():
+            now = format_timestamp(time_stamp)
+            print now, 'OPC Data Quality changed to', quality, 'for %i tag(s)' % len(tag_rows)
+            if self._options.verbose:
+                for tag_row in tag_rows:
+                    print '\t' + tag_row.tag_name
+
+            live_ids = [tag_row.id for tag_row in tag_rows if tag_row.live]
+            if live_ids:
+                self.db(self.db.PLC_Live_Data.tag_id.belongs(live_ids)).update(time_stamp=now, quality=quality)
+            new_rows = [dict(tag_id=tag_row.id, time_stamp=now, quality=quality)
+                        for tag_row in tag_rows if not tag_row.live]
+            if new_rows:
+                self.db.PLC_Live_Data.bulk_insert(new_rows)
+        self.db.commit()
+
+        # only once committed, so a failed write is retried on the next scan
+        for (quality, time_stamp), tag_rows in quality_changes.iteritems():
+            for tag_row in tag_rows:
+                tag_row.quality = quality
+                tag_row.time_stamp = time_stamp
+                tag_row.live = True
+
+    def _log_item(self, tag_row, item, hist_query, data_format):
+        """
+        writes a good quality OPC item to the history, events and live data tables
+        """
+        cur_val = item.value
+        now = format_timestamp(item.time_stamp)
+        if tag_row.log_hist:
+            self.db.PLC_Hist_Data.insert(tag_id=tag_row.id, time_stamp=now, val=cur_val)
+
+            if tag_row.insert_trigger == 1 and cur_val == 0:
+                # OPC source timestamps only have whole seconds, so a pulse shorter than a second has its
+                # start row at the same time_stamp; ties are broken by insert order (id)
+                start = self.db(hist_query &
+                               (self.db.PLC_Hist_Data.val == '1') &
+                               (self.db.PLC_Hist_Data.time_stamp <= now) &
+                               (self.db.PLC_Hist_Data.tag_id == tag_row.id)).select(self.db.PLC_Hist_Data.ALL,
+                                                     orderby=~self.db.PLC_Hist_Data.time_stamp |
+                                                             ~self.db.PLC_Hist_Data.id).first()
+                if start:
+                    delta = item.time_stamp - start.time_stamp
+                    self.db.PLC_Events.insert(tag_id=tag_row.id,
+                                              start_time=format_timestamp(start.time_stamp),
+                                              end_time=now,
+                                              duration=delta)
+
+        if self._is_current(tag_row, item):
+            self.db.PLC_Live_Data.update_or_insert(self.db.PLC_Live_Data.tag_id == tag_row.id,
+                                                   tag_id=tag_row.id,
+                                                   time_stamp=now,
+                                                   val=cur_val,
+                                                   quality=item.quality)
+            tag_row.time_stamp = item.time_stamp
+            tag_row.live = True
+            tag_row.quality = item.quality
+
+        if self._options.verbose:
+            print data_format.format("", *[tag_row.tag_name,
+                                           tag_row.name,
+                                           self.db.PLC_Tag_Type[tag_row.tag_type_id].tag_type,
+                                           self.db.PLC_Equipment[tag_row.equipment_id].equipment,
+                                           now,
+                                           cur_val])
+        self.db.commit()
+
+    def scan(self, hist_query, data_format):
+        """
+        Processes one read of the OPC group (self._current_state) against the previous read.
+
+        Bad quality items are skipped without raising; only their transitions are recorded, in bulk
+        after the scan.  A tag coming back to good quality is always logged since its value is unknown
+        for the outage.
+        """
+        quality_changes = {}
+        for id_, this_tag_row in self.plc_tags_dict.iteritems():
+            item = self._current_state[this_tag_row.tag_name]
+            try:
+                if item.quality != OPC_GOOD:
+                    if item.quality != this_tag_row.quality and self._is_current(this_tag_row, item):
+                        quality_changes.setdefault((item.quality, item.time_stamp), []).append(this_tag_row)
+                    continue
+
+                recovered = (this_tag_row.quality != OPC_GOOD or
+                             self._prev_state[this_tag_row.tag_name].quality != OPC_GOOD)
+                # trigger_detect always runs so edge flags and trigger times follow the recovered value
+                triggered = self.trigger_detect(id_)
+                if recovered and not triggered:
+                    this_tag_row.time = time.time()
+                if triggered or recovered:
+                    self._log_item(this_tag_row, item, hist_query, data_format)
+
+            except OperationalError, e:
+                print 'sqlite3 Operational Error: ', e
+                self._run = False
+            except Exception, e:
+                print this_tag_row.tag_name, format_timestamp(item.time_stamp), item.quality, 'Exception:', e
+
+        if quality_changes:
+            try:
+                self._record_quality_changes(quality_changes)
+            except OperationalError, e:
+                print 'sqlite3 Operational Error: ', e
+                self._run = False
+            except Exception, e:
+                self.db.rollback()
+                print 'Exception while recording OPC quality changes:', e
+
     def run(self, skip=False):
         """
         Starts a while loop that performs asynchronous reads on RSLinx and loads any changes to the database
@@ -564,7 +811,6 @@ class PyPLC2SQL(object):
         data_format = "|{}{: <55}|{: ^30}|{: ^20}|{: ^20}|{: ^25}|{: ^20}|"
         header_titles = header_format.format("", *['Tag', 'Name', 'Description', 'Equipment', 'Timestamp', 'Value'])
         header = '\n' + '\n'.join(['-' * len(header_titles), header_titles, '-' * len(header_titles)])
-        now = dt.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3:]
         hist_query = ((self.db.PLC_Hist_Data.tag_id == self.db.PLC_Tags.id) &
          (self.db.PLC_Tags.tag_type_id == self.db.PLC_Tag_Type.id) &
          (self.db.PLC_Tags.equipment_id == self.db.PLC_Equipment.id))
@@ -581,14 +827,8 @@ class PyPLC2SQL(object):
         if self._options.verbose:
             print header
 
-        # copy tags table from db into memory so we can use it if the db locks up
         try:
-            plc_tags_rows = self.db().select(self.db.PLC_Tags.ALL)
-            for row in plc_tags_rows:
-                row.trigger_setting = row.trigger_setting.split('/')
-                row.time = time.time()
-                row.flag = False
-                self.plc_tags_dict[row['id']] = row
+            self._load_tag_rows()
         except OperationalError, e:
             print 'sqlite Operational Error during run method:', e
             restart()
@@ -597,52 +837,7 @@ class PyPLC2SQL(object):
         while self._run:
             #self.plc_tags_dict = self._tag_table_data_update()
             self._current_state = self.read_tags()
-
-            for id_ in self.plc_tags_dict.keys():
-                now = dt.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3:]
-                this_tag_row = self.plc_tags_dict[id_]
-                cur_val, quality = self._current_state[this_tag_row.tag_name]
-                if self.trigger_detect(id_):
-                    try:
-                        # if not self._opc.ping():
-                        #     raise Exception('OPC server not communicating.')
-                        if quality != 'Good':
-                            raise Exception('OPC Data Quality Not Good.')
-                        if this_tag_row.log_hist:
-                            self.db.PLC_Hist_Data.insert(tag_id=this_tag_row.id, time_stamp=now, val=cur_val)
-
-                            if this_tag_row.insert_trigger == 1 and cur_val == 0:
-                                start = self.db(hist_query &
-                                               (self.db.PLC_Hist_Data.val == '1') &
-                                               (self.db.PLC_Hist_Data.time_stamp < now) &
-                                               (self.db.PLC_Hist_Data.tag_id == id_)).select(self.db.PLC_Hist_Data.ALL,
-                                                                     orderby=~self.db.PLC_Hist_Data.time_stamp).first()
-                                if start:
-                                    delta = dt.now() - start.time_stamp
-                                    self.db.PLC_Events.insert(tag_id=id_,
-                                                              start_time=start.time_stamp.strftime("%Y-%m-%d %H:%M:%S.%f")[:-3:],
-                                                              end_time=now,
-                                                              duration=delta)
-
-                        self.db.PLC_Live_Data.update_or_insert(self.db.PLC_Live_Data.tag_id == this_tag_row.id,
-                                                               tag_id=this_tag_row.id,
-                                                               time_stamp=now,
-                                                               val=cur_val)
-
-                        if self._options.verbose:
-                            print data_format.format("", *[this_tag_row.tag_name,
-                                                           this_tag_row.name,
-                                                           self.db.PLC_Tag_Type[this_tag_row.tag_type_id].tag_type,
-                                                           self.db.PLC_Equipment[this_tag_row.equipment_id].equipment,
-                                                           now,
-                                                           cur_val])
-                        self.db.commit()
-
-                    except OperationalError, e:
-                        print 'sqlite3 Operational Error: ', e
-                        self._run = False
-                    except Exception, e:
-                        print this_tag_row.tag_name, now, quality, 'Exception:', e
+            self.scan(hist_query, data_format)
 
             self._options.init = False
             self._prev_state = self._current_state
@@ -0,0 +1,112 @@
+__author__ = 'LandrCod'
+
+"""
+Benchmark for the ingest scan of PyPLC2SQL.
+
+Times PyPLC2SQL.read_tags() and scan() against an in-memory sqlite database and a simulated
+OpenOPC client for a growing percentage of bad quality tags.  The first scan after the tags go
+bad records their quality change; every later scan should stay flat (or drop) as tags go bad,
+since bad quality items are only recorded when their quality changes.
+
+Usage:
+    python benchmark_scan.py [tag count] [scans]
+"""
+
+from collections import namedtuple
+from datetime import datetime as dt, timedelta
+from os import devnull
+import sys
+import time
+
+from PyPLC2SQL import PyPLC2SQL, OPC_GOOD, OPENOPC_TS_FORMAT, TRIGGERS
+
+
+TAG_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+SCANS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+BAD_PERCENTS = (0, 25, 50, 100)
+
+
+class SimulatedOPC(object):
+    """
+    stands in for an OpenOPC client.  The first bad_count tags have dropped offline and share the
+    timestamp of the failure; every good tag has its own timestamp string, the worst case for parsing.
+    """
+
+    def __init__(self):
+        self.bad_count = 0
+        self._clock = dt(2020, 1, 1)
+
+    def read(self, tags, group=None):
+        self._clock += timedelta(seconds=1)
+        failed = self._clock.strftime(OPENOPC_TS_FORMAT)
+        return [(tag, None, 'Bad', failed) if i < self.bad_count else
+                (tag, 0, OPC_GOOD, (self._clock - timedelta(seconds=i)).strftime(OPENOPC_TS_FORMAT))
+                for i, tag in enumerate(tags)]
+
+
+def build_app(tag_count):
+    """
+    builds a PyPLC2SQL instance on an in-memory database without connecting to an OPC server
+    """
+    app = PyPLC2SQL.__new__(PyPLC2SQL)
+    app._CONFIG = namedtuple('Config', ['DB_STRING', 'DB_FOLDER', 'OPC_TS_UTC'])('sqlite:memory', None, 'True')
+    app._opc = SimulatedOPC()
+    app._options = namedtuple('Options', ['verbose', 'init'])(False, True)
+    app.plc_tags_dict = {}
+    app.connect_to_database()
+    type_id = app.db.PLC_Tag_Type.insert(tag_type='BENCHMARK')
+    equipment_id = app.db.PLC_Equipment.insert(equipment='BENCHMARK')
+    for i in range(tag_count):
+        app.db.PLC_Tags.insert(tag_name='[BENCH]Tag[%i]' % i, name='tag %i' % i,
+                               insert_trigger=TRIGGERS['VALUE_CHANGE'], trigger_setting='0',
+                               log_hist=True, tag_type_id=type_id, equipment_id=equipment_id)
+    app.db.commit()
+    app._load_tag_rows()
+    app._tags = [row.tag_name for row in app.plc_tags_dict.values()]
+    return app
+
+
+def benchmark(bad_percent):
+    # keep connection banners and quality change messages out of the results table
+    stdout, sys.stdout = sys.stdout, open(devnull, 'w')
+    try:
+        return _benchmark(bad_percent)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _benchmark(bad_percent):
+    app = build_app(TAG_COUNT)
+    hist_query = ((app.db.PLC_Hist_Data.tag_id == app.db.PLC_Tags.id) &
+                  (app.db.PLC_Tags.tag_type_id == app.db.PLC_Tag_Type.id) &
+                  (app.db.PLC_Tags.equipment_id == app.db.PLC_Equipment.id))
+
+    # warm up on an all good read so every bad tag is a transition on the first timed scan.  Like a
+    # restart it logs every tag once, so each tag has a live data row.
+    app._current_state = app.read_tags()
+    app._prev_state = app._current_state
+    app.scan(hist_query, None)
+    app._options = app._options._replace(init=False)
+
+    app._opc.bad_count = TAG_COUNT * bad_percent // 100
+    times = []
+    for _ in range(SCANS):
+        start = time.time()
+        app._current_state = app.read_tags()
+        app.scan(hist_query, None)
+        times.append(time.time() - start)
+        app._prev_state = app._current_state
+    app.db.close()
+    return times
+
+
+if __name__ == "__main__":
+    print "{: >10}|{: >20}|{: >20}|{: >20}".format('% Bad', 'Transition Scan (ms)', 'Mean Scan (ms)', 'Max Scan (ms)')
+    for bad_percent in BAD_PERCENTS:
+        times = benchmark(bad_percent)
+        steady = times[1:] or times
+        print "{: >10}|{: >20.3f}|{: >20.3f}|{: >20.3f}".format(bad_percent,
+                                                                 times[0] * 1000,
+                                                                 sum(steady) / len(steady) * 1000,
+                                                                 max(steady) * 1000)